@@ -40,11 +40,11 @@ class Optimizable:
             self.all_params_with_gradients.append(param)
         self.optimizer.begin()
 
-    def zero_grad(self):
-        ''' Set all gradients to zero. '''
+    def zero_grad(self, set_to_none=False):
+        ''' Set all gradients to zero, or to None if set_to_none. '''
         for param in self.all_params_with_gradients:
-            param.grad = torch.zeros_like(param)
-        self.optimizer.zero_grad()
+            param.grad = None if set_to_none else torch.zeros_like(param)
+        self.optimizer.zero_grad(set_to_none)
 
     ''' Note: at this point you would probably call .backwards() on the loss
     function. '''
@@ -70,7 +70,7 @@ class NoOpOptimizer(Optimizable):
     def begin(self):
         pass
 
-    def zero_grad(self):
+    def zero_grad(self, set_to_none=False):
         pass
 
     def step(self, params):
@@ -148,10 +148,12 @@ class SGDPerParamMo(Optimizable):
     def step(self, params):
         self.optimizer.step(self.parameters)
         for name, param in params.items():
-            g = param.grad.detach()
             p = param.detach()
             if name + '_alpha' not in self.parameters: params[name] = p
             else:
+                # a None grad (zero_grad(set_to_none=True) and no gradient since) counts as zero: the
+                # update below must still run, it is what connects the new param to its hyper-lr
+                g = param.grad.detach() if param.grad is not None else torch.zeros_like(p)
                 if  self.parameters[name + '_mu'] != 0.0:
                     if name not in self.state:
                         buf = self.state[name] = g
@@ -512,17 +514,19 @@ class ModuleWrapper(Optimizable):
     def initialize(self):
         self.optimizer.initialize()
     
-    def zero_grad(self):
-        """ Set all gradients to zero. """
+    def zero_grad(self, set_to_none=False):
+        """ Set all gradients to zero, or to None if set_to_none. """
         self.module.zero_grad()
         for param in self.all_params_with_gradients:
-            if param.grad != None:
+            if set_to_none:
+                param.grad = None
+            elif param.grad != None:
                 param.grad.detach_()
                 param.grad.zero_()
             else:
                 param.grad = torch.zeros_like(param.data)
             #param.grad = torch.zeros_like(param.data)
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none)
     
     def detach(self):
         """ Set all gradients to zero. """
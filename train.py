@@ -20,12 +20,10 @@ import sys
 import os
 import time
 import math
+import mmap
 import pickle
 from contextlib import nullcontext
-
-from matplotlib.lines import Line2D  
-import matplotlib.pyplot as plt
-
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -44,7 +42,7 @@ from model import GPTConfig, GPT
 # I/O
 out_dir = 'out-shakespeare'
 eval_interval = 2000
-log_interval = 1
+log_interval = 10 # logging syncs with the GPU, so don't do it every iter
 eval_iters = 200
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
@@ -58,6 +56,7 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 1 # used to simulate larger batch sizes
 batch_size = 12 # if gradßient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+memmap_refresh_iters = 10000 # re-open the token memmaps this often to bound their memory use, 0 = never
 # model
 hypergrad = True    
 n_layer = 12
@@ -87,6 +86,7 @@ backend = 'nccl' # 'nccl', 'gloo', etc.
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc., or try 'mps' on macbooks
 dtype = 'bfloat16' # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
 compile = True # use PyTorch 2.0 to compile the model to be faster
+compile_mode = 'default' # torch.compile mode, e.g. 'max-autotune-no-cudagraphs'. cudagraph modes don't suit the per-step parameter swap
 adam = False
 hyperadam = False
 
@@ -124,23 +124,62 @@ if master_process:
 torch.manual_seed(1337 + seed_offset)
 torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
 torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True # allow reduced precision reductions in bf16 gemms
+torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = True # allow reduced precision reductions in fp16 gemms
+torch.backends.cudnn.benchmark = True # shapes are fixed for the whole run, so autotuning pays off after a few iters
 device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
 # note: float16 data type will automatically use a GradScaler
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+# scaled_dot_product_attention backends to pick from: the fused flash / memory-efficient kernels
+# never materialize the (T, T) attention matrix, math is only the fallback. restricting them to a
+# list needs PyTorch >= 2.3, on older versions SDPA is left to choose (or model.py does it manually)
+sdpa_backends = None
+if tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 3):
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+    sdpa_backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+def sdpa_ctx():
+    return sdpa_kernel(sdpa_backends) if sdpa_backends is not None else nullcontext()
 
 # data loader
 data_dir = os.path.join('data', dataset)
-def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
+_memmaps = {} # split -> (np.memmap of the token file, iter_num it was opened at)
+_offsets = np.arange(block_size + 1) # (T+1,) token offsets covering both x and the shifted y
+def open_token_memmap(split):
+    data = np.memmap(os.path.join(data_dir, f'{split}.bin'), dtype=np.uint16, mode='r')
+    # batches are read at random offsets, so kernel readahead around each one is wasted IO
+    mm = getattr(data, '_mmap', None)
+    if mm is not None and hasattr(mmap, 'MADV_RANDOM'):
+        mm.madvise(mmap.MADV_RANDOM)
+    return data
+
+# batch offsets come from a seeded PCG64 generator, drawn _offset_pool_rows batches at a time per split
+_rng = np.random.default_rng(1337 + seed_offset)
+_offset_pool_rows = 1024
+_offset_pools = {} # split -> [(_offset_pool_rows, batch_size) int64 array of offsets, index of the next unused row]
+def sample_offsets(split, high):
+    pool = _offset_pools.get(split)
+    if pool is None or pool[1] == len(pool[0]):
+        pool = _offset_pools[split] = [_rng.integers(0, high, size=(_offset_pool_rows, batch_size), dtype=np.int64), 0]
+    ix = pool[0][pool[1]]
+    pool[1] += 1
+    return ix
+
+def load_batch(split):
+    # Recreating np.memmap avoids a slow memory leak, as per
     # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+    # but doing it every batch costs an mmap/munmap per step, so only refresh it periodically
+    data, opened_at = _memmaps.get(split, (None, 0))
+    if data is None or (memmap_refresh_iters > 0 and iter_num - opened_at >= memmap_refresh_iters):
+        data = open_token_memmap(split)
+        _memmaps[split] = (data, iter_num)
+    ix = sample_offsets(split, len(data) - block_size)
+    # gather all batch_size windows with a single fancy index into one contiguous (B, T+1) int64 buffer
+    return data[ix[:, None] + _offsets].astype(np.int64)
+
+def get_batch(split):
+    xy = torch.from_numpy(load_batch(split))
+    x, y = xy[:, :-1].contiguous(), xy[:, 1:].contiguous()
     if device_type == 'cuda':
         # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
         x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
@@ -148,6 +187,62 @@ def get_batch(split):
         x, y = x.to(device), y.to(device)
     return x, y
 
+class _Prefetcher:
+    """
+    Prefetched training batches: while the current batch is being consumed,
+    the next one is already being copied host->device on a dedicated CUDA stream,
+    so the memmap reads and the PCIe transfer overlap with forward/backward.
+    The batch shape is fixed for the whole run, so the pinned host and the device
+    buffers are allocated once and cycled through instead of allocated every batch.
+    """
+    # one slot in use by the current step (its backward still reads X and Y), one holding
+    # the batch handed out next and one being filled, so a slot is never overwritten in use
+    num_slots = 3
+
+    def __init__(self, split):
+        self.split = split
+        self.slot = 0
+        if device_type == 'cuda':
+            self.copy_stream = torch.cuda.Stream()
+            shape = (batch_size, block_size)
+            self.h_x = [torch.empty(shape, dtype=torch.int64).pin_memory() for _ in range(self.num_slots)]
+            self.h_y = [torch.empty(shape, dtype=torch.int64).pin_memory() for _ in range(self.num_slots)]
+            self.d_x = [torch.empty(shape, dtype=torch.int64, device=device) for _ in range(self.num_slots)]
+            self.d_y = [torch.empty(shape, dtype=torch.int64, device=device) for _ in range(self.num_slots)]
+            self.copied = [None] * self.num_slots # event marking the end of each slot's last host->device copy
+        else:
+            self.copy_stream = None
+        self.curr = None
+        self._advance()
+
+    def _advance(self):
+        xy = load_batch(self.split)
+        if self.copy_stream is None:
+            xy = torch.from_numpy(xy)
+            self.next = (xy[:, :-1].contiguous().to(device), xy[:, 1:].contiguous().to(device))
+            return
+        s = self.slot
+        self.slot = (s + 1) % self.num_slots
+        # the host buffers may only be refilled once their previous copy to the device has finished
+        if self.copied[s] is not None:
+            self.copied[s].synchronize()
+        self.h_x[s].numpy()[...] = xy[:, :-1]
+        self.h_y[s].numpy()[...] = xy[:, 1:]
+        # and the device buffers only once the steps queued so far are done reading them
+        self.copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.copy_stream):
+            self.d_x[s].copy_(self.h_x[s], non_blocking=True)
+            self.d_y[s].copy_(self.h_y[s], non_blocking=True)
+            self.copied[s] = self.copy_stream.record_event()
+        self.next = (self.d_x[s], self.d_y[s])
+
+    def next_batch(self):
+        if self.copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(self.copy_stream)
+        self.curr = self.next
+        self._advance()
+        return self.curr
+
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
 best_val_loss = 1e9
@@ -211,8 +306,13 @@ if block_size < model.config.block_size:
 model.to(device)
 for n, p in model.named_parameters():
     print(n, p.shape)
-# initialize a GradScaler. If enabled=False scaler is a no-op
-scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
+# initialize a GradScaler, only needed (and only created) when training in float16.
+# the Meta hyperparameters live on the CPU, so unscaling their grads needs the device-generic
+# torch.amp.GradScaler of PyTorch >= 2.3
+scaler = None
+if dtype == 'float16':
+    assert hasattr(torch.amp, 'GradScaler'), "training in float16 requires PyTorch >= 2.3"
+    scaler = torch.amp.GradScaler(device_type)
 
 
 # optimizer
@@ -223,53 +323,75 @@ if init_from == 'resume':
     optimizer.load_state_dict(checkpoint['optimizer'])
 checkpoint = None # free up memory
 
-# compile the model
+# compile the model. only the transformer blocks are compiled: the outer GPT stays eager, so dynamo
+# never has to trace through the gdtuo.ModuleWrapper that swaps the parameters in every step
 if compile:
-    print("compiling the model... (takes a ~minute)")
-    unoptimized_model = model
-    model = torch.compile(model) # requires PyTorch 2.0
+    print("compiling the transformer blocks... (takes a ~minute)")
+    # all blocks share the code of Block.forward, so each block (in train and eval mode) takes its own
+    # entry in that code's dynamo cache: leave room for them all instead of recompiling past the limit,
+    # and fall back to eager for a frame that fails to compile rather than aborting the run
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+    torch._dynamo.config.suppress_errors = True
+    for block in model.transformer.h:
+        block.forward = torch.compile(block.forward, mode=compile_mode, dynamic=False, fullgraph=False) # requires PyTorch 2.0
 
 # wrap model into DDP container
 if ddp:
     model = DDP(model, device_ids=[ddp_local_rank])
 
 # helps estimate an arbitrarily accurate loss over either split using many batches
-@torch.no_grad()
+@torch.inference_mode()
 def estimate_loss():
     out = {}
     model.eval()
     for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
+        # accumulate on the device and sync once per split, rather than once per batch
+        losses = torch.empty(eval_iters, device=device)
         for k in range(eval_iters):
             X, Y = get_batch(split)
-            with ctx:
+            with ctx, sdpa_ctx():
                 logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+            losses[k] = loss
+        out[split] = losses.mean().item()
     model.train()
     return out
 
-# learning rate decay scheduler (cosine with warmup)
-def get_lr(it):
+# learning rate decay scheduler (cosine with warmup), precomputed for every iteration up front
+# so that the training loop only has to index into it
+def get_lr_schedule(num_iters):
+    it = np.arange(num_iters + 1, dtype=np.float64)
     # 1) linear warmup for warmup_iters steps
-    if it < warmup_iters:
-        return learning_rate * it / warmup_iters
-    # 2) if it > lr_decay_iters, return min learning rate
-    if it > lr_decay_iters:
-        return min_lr
+    warmup = learning_rate * it / max(warmup_iters, 1)
     # 3) in between, use cosine decay down to min learning rate
-    decay_ratio = (it - warmup_iters) / (lr_decay_iters - warmup_iters)
-    assert 0 <= decay_ratio <= 1
-    coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
-    return min_lr + coeff * (learning_rate - min_lr)
+    decay_ratio = np.clip((it - warmup_iters) / (lr_decay_iters - warmup_iters), 0.0, 1.0)
+    coeff = 0.5 * (1.0 + np.cos(np.pi * decay_ratio)) # coeff ranges 0..1
+    lr = np.where(it < warmup_iters, warmup, min_lr + coeff * (learning_rate - min_lr))
+    # 2) if it > lr_decay_iters, use min learning rate
+    return np.where(it > lr_decay_iters, min_lr, lr)
+lr_table = get_lr_schedule(max_iters) if decay_lr else None
 
 # logging
 if wandb_log and master_process:
     import wandb
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 
+# checkpoints are serialized and written on a background thread, with at most one save in flight
+checkpoint_saver = ThreadPoolExecutor(max_workers=1)
+checkpoint_future = None
+def cpu_copy(obj):
+    """ copy of obj with every tensor in it cloned to the CPU, even ones already there, so the
+    saver thread never sees the in-place updates training keeps making to the live tensors """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+prefetcher = _Prefetcher('train')
+X, Y = prefetcher.next_batch() # fetch the very first batch
 t0 = time.time()
 local_iter_num = 0 # number of iterations in the lifetime of this process
 raw_model = model.module if ddp else model # unwrap DDP container if needed
@@ -281,29 +403,65 @@ optimizer_gdtuo = gdtuo.Meta(alpha=1e-3, beta1 = beta1, beta2 = beta2, beta3 = b
                              
 mw = gdtuo.ModuleWrapper(model, optimizer=optimizer_gdtuo)
 mw.initialize()
+# mw.step() swaps freshly computed tensors into the module every iteration, so cache the
+# parameter names once and look the current tensors up in mw.parameters, instead of
+# walking the module tree with model.parameters() every step
+param_names = [n for n, p in model.named_parameters()]
+decay_param_names = [n for n, p in model.named_parameters() if p.dim() >= 2 and p.requires_grad]
+hparam_names = ('beta1', 'beta2', 'beta3', 'rho', 'c', 'gamma')
+def hparam_snapshot(hparams):
+    """ the tracked hyperparameters as one numpy row (in hparam_names order), with a single host transfer """
+    return torch.stack([hparams[n].detach() for n in hparam_names]).float().cpu().numpy()
 t = 0
+prev_lr = None # lr written into the optimizer and alpha last, to skip rewriting an unchanged one
+train_loss_nan = False # from the most recent eval, kept outside of it so the termination check is always valid
 print(f"beta1 {Meta.clamp(mw.optimizer.parameters['beta1']):.4f}, beta2 {Meta.clamp(mw.optimizer.parameters['beta2'], 0.501,0.99):.4f}, beta3 {Meta.clamp(mw.optimizer.parameters['beta3'], 0.0, 1.0):.4f}, alpha {mw.optimizer.parameters['alpha']}")
-beta1_init = mw.optimizer.parameters['beta1']
-beta2_init = mw.optimizer.parameters['beta2']
-beta3_init = mw.optimizer.parameters['beta3']
-rho_init = mw.optimizer.parameters['rho']
-c_init = mw.optimizer.parameters['c']
-gamma_init = mw.optimizer.parameters['gamma']
+hparams_init = {n: mw.optimizer.parameters[n] for n in hparam_names}
+
+class _HyperStep:
+    """
+    Presents the gdtuo update to the GradScaler as if it were a torch.optim.Optimizer:
+    unscale_() sees the model and hyperparameter grads, step() runs mw.step() unless they overflowed.
+    """
+
+    def __init__(self, mw):
+        self.mw = mw
+
+    @property
+    def param_groups(self):
+        # dedupe by identity, the tied wte/lm_head weight shows up under two names in mw.parameters
+        params = {id(p): p for p in [*self.mw.parameters.values(), *self.mw.optimizer.parameters.values()]}
+        return [{'params': list(params.values())}]
+
+    def step(self):
+        self.mw.step()
+        return True
+
+    def skip(self):
+        # the update was skipped, but the graph behind the current tensors was consumed by this
+        # backward already. detach them in place so that the next backward stops at them
+        for p in self.param_groups[0]['params']:
+            p.detach_()
+
+hyper_step = _HyperStep(mw)
 
 while True:
     
     
-    lr = get_lr(iter_num) if decay_lr else learning_rate
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-    mw.optimizer.parameters['alpha'].data = torch.tensor(lr)
-    
+    lr = float(lr_table[min(iter_num, max_iters)]) if decay_lr else learning_rate
+    if lr != prev_lr:
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
+        # rebind alpha rather than fill_() it in place: the previous update saved alpha for the
+        # hypergradient backward that is still to come, and must keep seeing the old value
+        mw.optimizer.parameters['alpha'].data = torch.tensor(lr)
+        prev_lr = lr
 
     # evaluate the loss on train/val sets and write checkpoints
     if iter_num % eval_interval == 0 and master_process:
         losses = estimate_loss()
         print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+        train_loss_nan = math.isnan(losses['train'])
         if wandb_log:
             wandb.log({
                 "iter": iter_num,
@@ -315,7 +473,8 @@ while True:
         if losses['val'] < best_val_loss or always_save_checkpoint:
             best_val_loss = losses['val']
             if iter_num > 0:
-                checkpoint = {
+                # snapshot to CPU here, so training can carry on while the worker thread writes it
+                checkpoint = cpu_copy({
                     'model': raw_model.state_dict(),
                     'optimizer': optimizer.state_dict(),
                     'model_args': model_args,
@@ -324,47 +483,72 @@ while True:
                     'config': config,
                     'beta1': Meta.clamp(mw.optimizer.parameters['beta1']),
                     'beta2': Meta.clamp(mw.optimizer.parameters['beta2'],0.5)
-                }
+                })
                 print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                if checkpoint_future is not None:
+                    checkpoint_future.result() # wait for the previous save, a slow disk must not pile them up
+                checkpoint_future = checkpoint_saver.submit(torch.save, checkpoint, os.path.join(out_dir, 'ckpt.pt'))
 
     if iter_num == 0 and eval_only:
         break
 
 
     mw.begin()
-    mw.zero_grad()
-    
-
-    logits, loss = mw.forward(X, Y)
-    loss = loss/gradient_accumulation_steps
+    mw.zero_grad(set_to_none=True)
     
-    # backward pass, with gradient scaling if training in fp16
 
-    loss.backward()
-    mw.optimizer.parameters['alpha'].grad = torch.zeros_like(mw.optimizer.parameters['alpha'].grad)
+    # forward backward, with optional gradient accumulation to simulate larger batch size
+    for micro_step in range(gradient_accumulation_steps):
+        last_micro_step = micro_step == gradient_accumulation_steps - 1
+        # in DDP only the last micro step needs to all-reduce the gradients, the others accumulate locally
+        sync_ctx = model.no_sync() if ddp and not last_micro_step else nullcontext()
+        with sync_ctx:
+            with ctx, sdpa_ctx():
+                logits, loss = mw.forward(X, Y)
+                loss = loss/gradient_accumulation_steps # scale the loss to account for gradient accumulation
+            # prefetch the next micro batch so its host->device copy overlaps the backward pass
+            X, Y = prefetcher.next_batch()
+            # backward pass, with gradient scaling if training in fp16
+            # the hypergradient graph through the previous update is shared by every micro step,
+            # so it has to outlive all but the last backward
+            if scaler is not None:
+                scaler.scale(loss).backward(retain_graph=not last_micro_step)
+            else:
+                loss.backward(retain_graph=not last_micro_step)
+    # SGDPerParamMo treats a None grad as a zero one
+    mw.optimizer.parameters['alpha'].grad = None
     if adam:
         for n, p in mw.optimizer.parameters.items():
-            p.grad = torch.zeros_like(p)
+            p.grad = None
     elif hyperadam:
         for n, p in mw.optimizer.parameters.items():
             if n != 'beta1' and n != 'beta2':
-                p.grad = torch.zeros_like(p)
-    X, Y = get_batch('train')
+                p.grad = None
     # clip the gradient
-    
     if grad_clip != 0.0:
-        torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-        for n,v in mw.optimizer.parameters.items():
-            torch.nn.utils.clip_grad_norm_(v,10.0)
+        if scaler is not None:
+            scaler.unscale_(hyper_step)
+        torch.nn.utils.clip_grad_norm_([mw.parameters[n] for n in param_names], grad_clip)
+        # each hyperparameter's gradient is clipped to norm 10 on its own, batched into one pass
+        hyper_grads = [v.grad for v in mw.optimizer.parameters.values() if v.grad is not None]
+        if hyper_grads:
+            hyper_norms = torch.stack(torch._foreach_norm(hyper_grads))
+            torch._foreach_mul_(hyper_grads, (10.0 / (hyper_norms + 1e-6)).clamp(max=1.0).unbind())
+    #manual weight decay, as one multi-tensor kernel (alpha is pinned to lr above):
+    with torch.no_grad():
+        torch._foreach_mul_([mw.parameters[n] for n in decay_param_names], 1.0 - lr * weight_decay)
     # step the optimizer and scaler if training in fp16
-    
-    #manual weight decay:
-    for p in model.parameters():
-        if p.data.dim() >= 2 and p.requires_grad:
-            p.data.copy_(p.data - mw.optimizer.parameters['alpha']*weight_decay*p.data)
-    mw.step()
+    if scaler is not None:
+        if scaler.step(hyper_step) is None:
+            hyper_step.skip()
+        scaler.update()
+    else:
+        mw.step()
+    # not redundant: Meta.step keeps each param.grad as its cache['g'], and this zeroes it in place
     mw.zero_grad()
+    # beta2 has effectively had a 0.51 floor (tighter than the 0.501 of Meta.step): the per-iter
+    # Meta.clamp in the log print used to write it back. keep enforcing it now that printing doesn't
+    Meta.clamp(mw.optimizer.parameters['beta2'], 0.51, 0.99)
    
     
     device_id =  device[-1]
@@ -380,38 +564,36 @@ while True:
             mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
         print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%") 
-        print(f"beta1 {Meta.clamp(mw.optimizer.parameters['beta1']):.4f}, beta2 {Meta.clamp(mw.optimizer.parameters['beta2'], 0.51,0.99):.4f}, beta3 {Meta.clamp(mw.optimizer.parameters['beta3'],0.0,1.0):.4f}, rho {Meta.clamp(mw.optimizer.parameters['rho'],0.0,1.0):.4f}, c {Meta.clamp(mw.optimizer.parameters['c'],0.0,1.0):.4f}, gamma {Meta.clamp(mw.optimizer.parameters['gamma'],0.0,1.0):.4f}")#, hyper alpha {mw.optimizer.optimizer.parameters['alpha']}")
-        res = np.array([mw.optimizer.parameters['beta1'].detach().cpu(), mw.optimizer.parameters['beta2'].detach().cpu(), mw.optimizer.parameters['beta3'].detach().cpu(), mw.optimizer.parameters['rho'].detach().cpu(), mw.optimizer.parameters['c'].detach().cpu(), mw.optimizer.parameters['gamma'].detach().cpu(), losses['train'], losses['val']])
-        res = np.reshape(res,(1,8))
+        # clamp for display only
+        hp = np.clip(hparam_snapshot(mw.optimizer.parameters), [0.01, 0.51, 0.0, 0.0, 0.0, 0.0], [0.99, 0.99, 1.0, 1.0, 1.0, 1.0])
+        print(f"beta1 {hp[0]:.4f}, beta2 {hp[1]:.4f}, beta3 {hp[2]:.4f}, rho {hp[3]:.4f}, c {hp[4]:.4f}, gamma {hp[5]:.4f}")#, hyper alpha {mw.optimizer.optimizer.parameters['alpha']}")
         
     iter_num += 1
     local_iter_num += 1
 
     
     # termination conditions
-    if iter_num > max_iters or math.isnan(losses['train']):
+    if iter_num > max_iters or train_loss_nan:
         losses = estimate_loss()
-        res = np.array([beta1, beta2, losses['train']])
-        res = np.reshape(res,(1,3))
         
         print(device_id)
         print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%") 
         print(f"beta1 {mw.optimizer.parameters['beta1']:.4f}, beta2 {mw.optimizer.parameters['beta2']:.4f}, beta3 {mw.optimizer.parameters['beta3']:.4f}, alpha {mw.optimizer.parameters['alpha']}")
         
-        res = np.array([beta1_init.detach().cpu(), beta2_init.detach().cpu(), beta3_init.detach().cpu(), rho_init.detach().cpu(), c_init.detach().cpu(), gamma_init.detach().cpu(), losses['train'], losses['val']])
-        res = np.reshape(res,(1,8))
+        res = np.concatenate([hparam_snapshot(hparams_init), [losses['train'], losses['val']]])[None, :]
         
         if hypergrad:
-            if adam:
-                with open(out_dir + '/results/train_log_adam' + str(device_id) + '.txt', 'a+') as f:
-                    np.savetxt(f, res ,delimiter =', ', fmt='%f')
-            elif hyperadam:
-                with open(out_dir + '/results/train_log_hyperadam' + str(device_id) + '.txt', 'a+') as f:
-                    np.savetxt(f, res ,delimiter =', ', fmt='%f')
-            else:
-                with open(out_dir + '/results/train_log_mada_3_b3r' + str(device_id) + '.txt', 'a+') as f:
-                    np.savetxt(f, res ,delimiter =', ', fmt='%f')
+            run_name = 'adam' if adam else 'hyperadam' if hyperadam else 'mada_3_b3r'
+            # append the row in binary, like the data/*.bin token files. read the log back with
+            # np.fromfile(path, dtype=np.float32).reshape(-1, 8)
+            os.makedirs(os.path.join(out_dir, 'results'), exist_ok=True)
+            with open(os.path.join(out_dir, 'results', f'train_log_{run_name}{device_id}.bin'), 'ab') as f:
+                res.astype(np.float32).tofile(f)
         break
 
+# make sure the last checkpoint hit the disk (and surface any error from writing it)
+checkpoint_saver.shutdown(wait=True)
+if checkpoint_future is not None:
+    checkpoint_future.result()
 if ddp:
     destroy_process_group()